@@ -2,16 +2,20 @@
 # vim:fileencoding=utf-8
 # License: GPL v3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
+import hashlib
 import mimetypes
+import mmap
 import os
 import re
 import signal
 import sys
-import zlib
-from base64 import standard_b64encode
-from collections import namedtuple
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from math import ceil
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkstemp
 
 from kitty.cli import parse_args
 from kitty.constants import appname
@@ -20,9 +24,38 @@ from kitty.utils import TTYIO, fit_image, screen_size_function
 from ..tui.images import (
     ConvertFailed, NoImageMagick, OpenFailed, convert, fsenc, identify
 )
-from ..tui.operations import clear_images_on_screen, serialize_gr_command
+from ..tui.operations import clear_images_on_screen, gr_command_parts
+
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import standard_b64encode as b64encode
+
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+try:
+    from .icat_speedup import serialize_chunks
+except ImportError:
+    serialize_chunks = None
 
 screen_size = None
+output_batch = None
+output_batch_size = 0
+try:
+    iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, OSError, ValueError):
+    iov_max = -1
+if iov_max <= 0:
+    iov_max = 1024
+image_extensions = {
+    '.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif', '.webp': 'image/webp', '.bmp': 'image/bmp',
+    '.tif': 'image/tiff', '.tiff': 'image/tiff',
+}
+gr_response_pat = re.compile(b'\033_Gi=([12]);(.+?)\033\\\\')
 OPTIONS = '''\
 --align
 type=choices
@@ -85,18 +118,66 @@ scripting language that cannot make termios calls.
 
 
 def options_spec():
-    if not hasattr(options_spec, 'ans'):
-        options_spec.ans = OPTIONS.format(
-            appname='{}-icat'.format(appname),
-        )
-    return options_spec.ans
+    return OPTIONS
+
+
+def write_parts(parts):
+    global output_batch_size
+    if output_batch is not None:
+        output_batch.extend(parts)
+        output_batch_size += sum(map(len, parts))
+        # Also limit the number of parts, so that output for images sent as
+        # files, which is only a few small parts each, is not held back
+        if output_batch_size >= 65536 or len(output_batch) >= 64:
+            flush_output_batch()
+        return
+    write_to_terminal(parts)
+
+
+def flush_output_batch():
+    global output_batch_size
+    if output_batch:
+        parts = tuple(output_batch)
+        del output_batch[:]
+        output_batch_size = 0
+        write_to_terminal(parts)
+
+
+def write_to_terminal(parts):
+    # All output to the terminal goes through this function and is written
+    # directly to its file descriptor, so there is nothing to flush
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, OSError, ValueError):
+        sys.stdout.buffer.write(b''.join(parts))
+        sys.stdout.flush()
+        return
+    parts = list(parts)
+    while parts:
+        n = os.writev(fd, parts[:iov_max])
+        while parts and n >= len(parts[0]):
+            n -= len(parts.pop(0))
+        if n:
+            parts[0] = memoryview(parts[0])[n:]
+
+
+@contextmanager
+def batched_output():
+    # Coalesce the output for multiple images into fewer writes
+    global output_batch, output_batch_size
+    output_batch, output_batch_size = [], 0
+    try:
+        yield
+    finally:
+        flush_output_batch()
+        output_batch = None
 
 
 def write_gr_cmd(cmd, payload=None):
-    sys.stdout.buffer.write(serialize_gr_command(cmd, payload))
-    sys.stdout.flush()
+    write_parts(gr_command_parts(cmd, payload))
 
 
+@lru_cache(maxsize=128)
 def calculate_in_cell_x_offset(width, cell_width, align):
     if align == 'left':
         return 0
@@ -110,11 +191,11 @@ def calculate_in_cell_x_offset(width, cell_width, align):
 
 def set_cursor(cmd, width, height, align):
     ss = screen_size()
-    cw = int(ss.width / ss.cols)
+    cw = ss.cell_width
     num_of_cells_needed = int(ceil(width / cw))
     if num_of_cells_needed > ss.cols:
         w, h = fit_image(width, height, ss.width, height)
-        ch = int(ss.height / ss.rows)
+        ch = ss.cell_height
         num_of_rows_needed = int(ceil(height / ch))
         cmd['c'], cmd['r'] = ss.cols, num_of_rows_needed
     else:
@@ -125,13 +206,13 @@ def set_cursor(cmd, width, height, align):
         elif align == 'right':
             extra_cells = (ss.cols - num_of_cells_needed)
         if extra_cells:
-            sys.stdout.buffer.write(b' ' * extra_cells)
+            write_parts((b' ' * extra_cells,))
 
 
 def set_cursor_for_place(place, cmd, width, height, align):
     x = place.left + 1
     ss = screen_size()
-    cw = int(ss.width / ss.cols)
+    cw = ss.cell_width
     num_of_cells_needed = int(ceil(width / cw))
     cmd['X'] = calculate_in_cell_x_offset(width, cw, align)
     extra_cells = 0
@@ -139,20 +220,97 @@ def set_cursor_for_place(place, cmd, width, height, align):
         extra_cells = (place.width - num_of_cells_needed) // 2
     elif align == 'right':
         extra_cells = place.width - num_of_cells_needed
-    sys.stdout.buffer.write('\033[{};{}H'.format(place.top + 1, x + extra_cells).encode('ascii'))
+    write_parts((b'\033[%d;%dH' % (place.top + 1, x + extra_cells),))
+
+
+def iter_blocks(data, bs=49152):
+    # The views are released as soon as they have been consumed, or the
+    # generator is closed, so that data can be an mmap that is closed
+    # even if writing fails with an exception
+    with memoryview(data) as mv:
+        for i in range(0, len(mv), bs):
+            with mv[i:i + bs] as block:
+                yield block
+
+
+def deflate_stream(data, bs=49152):
+    # icat output is transient, so favor speed over compression ratio
+    co = zlib.compressobj(1)
+    blocks = iter_blocks(data, bs)
+    try:
+        for block in blocks:
+            yield co.compress(block)
+    finally:
+        blocks.close()
+    yield co.flush()
+
+
+def write_chunked_fast(cmd, blocks):
+    # Encode and serialize all complete chunks in each block in C
+    header = ','.join('{}={}'.format(k, v) for k, v in cmd.items()).encode('ascii')
+    cmd.clear()
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+        out, consumed = serialize_chunks(header, buf, True)
+        if consumed:
+            del buf[:consumed]
+            header = b''
+            write_parts((out,))
+    out, consumed = serialize_chunks(header, buf, False)
+    if out:
+        write_parts((out,))
+
+
+def write_chunked_py(cmd, blocks):
+    # Chunks are accumulated and written out in batches with a single gather
+    # write, to avoid a write per chunk and copying the payloads
+    out, out_size = [], 0
+
+    def flush():
+        nonlocal out_size
+        write_parts(out)
+        del out[:]
+        out_size = 0
+
+    def write_chunk(chunk, m):
+        nonlocal out_size
+        cmd['m'] = m
+        parts = gr_command_parts(cmd, b64encode(chunk))
+        cmd.clear()
+        out.extend(parts)
+        out_size += sum(map(len, parts))
+        if out_size >= 65536:
+            flush()
+
+    # base64 encodes 3 bytes as 4, so each 3072 byte block becomes exactly
+    # one 4096 byte chunk, and can be encoded and written independently.
+    # The last chunk is always held back so that it can be sent with m=0
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+        while len(buf) > 3072:
+            write_chunk(buf[:3072], 1)
+            del buf[:3072]
+    if buf:
+        write_chunk(buf, 0)
+    if out:
+        flush()
 
 
 def write_chunked(cmd, data):
     if cmd['f'] != 100:
-        data = zlib.compress(data)
+        blocks = deflate_stream(data)
         cmd['o'] = 'z'
-    data = standard_b64encode(data)
-    while data:
-        chunk, data = data[:4096], data[4096:]
-        m = 1 if data else 0
-        cmd['m'] = m
-        write_gr_cmd(cmd, chunk)
-        cmd.clear()
+    else:
+        blocks = iter_blocks(data)
+    try:
+        if serialize_chunks is not None:
+            write_chunked_fast(cmd, blocks)
+        else:
+            write_chunked_py(cmd, blocks)
+    finally:
+        blocks.close()
 
 
 def show(outfile, width, height, fmt, transmit_mode='t', align='center', place=None):
@@ -163,18 +321,19 @@ def show(outfile, width, height, fmt, transmit_mode='t', align='center', place=N
         set_cursor(cmd, width, height, align)
     if detect_support.has_files:
         cmd['t'] = transmit_mode
-        write_gr_cmd(cmd, standard_b64encode(os.path.abspath(outfile).encode(fsenc)))
+        write_gr_cmd(cmd, b64encode(os.path.abspath(outfile).encode(fsenc)))
     else:
-        with open(outfile, 'rb') as f:
-            data = f.read()
-        if transmit_mode == 't':
-            os.unlink(outfile)
-        if fmt == 100:
-            cmd['S'] = len(data)
-        write_chunked(cmd, data)
+        with open(outfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if transmit_mode == 't':
+                os.unlink(outfile)
+            if fmt == 100:
+                cmd['S'] = len(data)
+            write_chunked(cmd, data)
 
 
-def process(path, args, is_tempfile):
+def prepare(path, args, is_tempfile):
+    # Identify and if needed convert the image, returning the arguments
+    # for show(). Does not write to the terminal, so can run in a worker thread.
     m = identify(path)
     ss = screen_size()
     available_width = args.place.width * (ss.width / ss.cols) if args.place else ss.width
@@ -190,52 +349,179 @@ def process(path, args, is_tempfile):
         fmt = 24 if m.mode == 'rgb' else 32
         transmit_mode = 't'
         outfile, width, height = convert(path, m, available_width, available_height, args.scale_up)
-    show(outfile, width, height, fmt, transmit_mode, align=args.align, place=args.place)
+    return outfile, width, height, fmt, transmit_mode
+
+
+def display(prepared, args):
+    show(*prepared, align=args.align, place=args.place)
     if not args.place:
-        print()  # ensure cursor is on a new line
+        write_parts((b'\n',))  # ensure cursor is on a new line
+
+
+def process(path, args, is_tempfile):
+    prepared = None
+    try:
+        prepared = prepare(path, args, is_tempfile)
+    finally:
+        # A temporary file is only needed after this if it is displayed as
+        # is, otherwise the image has been converted to a different file
+        if is_tempfile and (prepared is None or prepared[0] != path):
+            safe_unlink(path)
+    display(prepared, args)
+
+
+def process_dir(d, args, errors):
+    # identify and convert run as external processes, so prepare images in
+    # worker threads while the images before them are being displayed, in order
+    num_workers = os.cpu_count() or 1
+    pending = deque()
+
+    def display_next():
+        try:
+            display(pending.popleft().result(), args)
+        except OpenFailed as e:
+            errors.append(e)
+        if detect_support.has_files:
+            # The terminal deletes converted temporary files only once it
+            # receives the command, so send it now, to bound how many exist
+            flush_output_batch()
+
+    with batched_output(), ThreadPoolExecutor(max_workers=num_workers) as executor:
+        try:
+            for x in scan(d):
+                pending.append(executor.submit(prepare, x[0], args, False))
+                if len(pending) > 2 * num_workers:
+                    display_next()
+            while pending:
+                display_next()
+        finally:
+            for job in pending:
+                job.cancel()
 
 
 def scan(d):
-    for dirpath, dirnames, filenames in os.walk(d):
-        for f in filenames:
-            mt = mimetypes.guess_type(f)[0]
-            if mt and mt.startswith('image/'):
-                yield os.path.join(dirpath, f), mt
+    try:
+        entries = list(os.scandir(d))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan(entry.path)
+            continue
+        if entry.is_dir():
+            continue  # symlink to a directory, not followed, like os.walk()
+        ext = os.path.splitext(entry.name)[1].lower()
+        mt = image_extensions.get(ext) or mimetypes.guess_type(entry.name)[0]
+        if mt and mt.startswith('image/'):
+            yield entry.path, mt
+
+
+def probe_tempfile():
+    # A file containing the data for a 1x1 RGBA image, used to detect
+    # support for file based transfer. Only created when the result of
+    # detection is not already cached. The data is required, the terminal
+    # reads the file and fails the query if it contains less than the 4
+    # bytes needed for the image.
+    fd, ans = mkstemp(prefix='kitty-icat-probe-')
+    try:
+        os.write(fd, b'abcd')
+    finally:
+        os.close(fd)
+    return ans
+
+
+def safe_unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def support_cache_path():
+    # The result of detect_support() is cached per terminal, identified by
+    # its tty, so that invoking icat repeatedly does not query the terminal
+    # every time
+    rdir = os.environ.get('XDG_RUNTIME_DIR')
+    if not rdir:
+        return
+    try:
+        tty = os.ttyname(sys.stdout.fileno())
+    except (AttributeError, OSError, ValueError):
+        return
+    if tty == os.ctermid():
+        return  # does not identify the terminal
+    key = '{}|{}|{}'.format(os.environ.get('TERM'), os.environ.get('KITTY_WINDOW_ID'), tty)
+    key = hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(rdir, 'kitty-icat-cap-' + key)
+
+
+def read_support_cache(path, max_age=3600):
+    try:
+        if time.time() - os.stat(path).st_mtime < max_age:
+            with open(path) as f:
+                return f.read()
+    except OSError:
+        pass
+
+
+def write_support_cache(path, has_files):
+    try:
+        with open(path, 'w') as f:
+            f.write('file' if has_files else 'stream')
+    except OSError:
+        pass
+
+
+def parse_gr_responses(received, scan_from, responses):
+    # Record the first reply to each of the i=1 and i=2 queries in responses.
+    # Returns the offset to resume scanning from when more data is received,
+    # the end of the last complete reply, so that a reply split across reads
+    # is still matched.
+    for m in gr_response_pat.finditer(received, scan_from):
+        idx = int(m.group(1)) - 1
+        if responses[idx] is None:
+            responses[idx] = m.group(2) == b'OK'
+        scan_from = m.end()
+    return scan_from
 
 
 def detect_support(wait_for=10, silent=False):
+    cache_path = support_cache_path()
+    if cache_path:
+        cached = read_support_cache(cache_path)
+        if cached in ('file', 'stream'):
+            detect_support.has_files = cached == 'file'
+            return True
     if not silent:
         print('Checking for graphics ({}s max. wait)...'.format(wait_for), end='\r')
     sys.stdout.flush()
+    probe_path = None
     try:
-        received = b''
-        responses = {}
-
-        def parse_responses():
-            for m in re.finditer(b'\033_Gi=([1|2]);(.+?)\033\\\\', received):
-                iid = m.group(1)
-                if iid in (b'1', b'2'):
-                    iid = int(iid.decode('ascii'))
-                    if iid not in responses:
-                        responses[iid] = m.group(2) == b'OK'
+        received = bytearray()
+        scan_from = 0
+        # The responses to the i=1 and i=2 queries, None until received
+        responses = [None, None]
 
         def more_needed(data):
-            nonlocal received
+            nonlocal received, scan_from
             received += data
-            parse_responses()
-            return 1 not in responses or 2 not in responses
-
-        with NamedTemporaryFile() as f:
-            f.write(b'abcd'), f.flush()
-            write_gr_cmd(dict(a='q', s=1, v=1, i=1), standard_b64encode(b'abcd'))
-            write_gr_cmd(dict(a='q', s=1, v=1, i=2, t='f'), standard_b64encode(f.name.encode(fsenc)))
-            with TTYIO() as io:
-                io.recv(more_needed, timeout=float(wait_for))
+            scan_from = parse_gr_responses(received, scan_from, responses)
+            return responses[0] is None or responses[1] is None
+
+        probe_path = probe_tempfile()
+        write_gr_cmd(dict(a='q', s=1, v=1, i=1), b64encode(b'abcd'))
+        write_gr_cmd(dict(a='q', s=1, v=1, i=2, t='f'), b64encode(probe_path.encode(fsenc)))
+        with TTYIO() as io:
+            io.recv(more_needed, timeout=float(wait_for))
     finally:
+        if probe_path is not None:
+            safe_unlink(probe_path)
         if not silent:
-            sys.stdout.buffer.write(b'\033[J'), sys.stdout.flush()
-    detect_support.has_files = bool(responses.get(2))
-    return responses.get(1, False)
+            write_parts((b'\033[J',))
+    detect_support.has_files = bool(responses[1])
+    if cache_path and responses[0] and None not in responses:
+        write_support_cache(cache_path, detect_support.has_files)
+    return bool(responses[0])
 
 
 def parse_place(raw):
@@ -300,7 +586,7 @@ def main(args=sys.argv):
         detect_support.has_files = args.transfer_mode == 'file'
     errors = []
     if args.clear:
-        sys.stdout.buffer.write(clear_images_on_screen(delete_data=True))
+        write_parts((clear_images_on_screen(delete_data=True),))
         if not items:
             return
     if not items:
@@ -308,7 +594,7 @@ def main(args=sys.argv):
     if args.place:
         if len(items) > 1 or (isinstance(items[0], str) and os.path.isdir(items[0])):
             raise SystemExit('The --place option can only be used with a single image')
-        sys.stdout.buffer.write(b'\0337')  # save cursor
+        write_parts((b'\0337',))  # save cursor
     for item in items:
         is_tempfile = False
         try:
@@ -318,8 +604,7 @@ def main(args=sys.argv):
                 item = tf.name
                 is_tempfile = True
             if os.path.isdir(item):
-                for x in scan(item):
-                    process(item, args)
+                process_dir(item, args, errors)
             else:
                 process(item, args, is_tempfile)
         except NoImageMagick as e:
@@ -329,7 +614,7 @@ def main(args=sys.argv):
         except OpenFailed as e:
             errors.append(e)
     if args.place:
-        sys.stdout.buffer.write(b'\0338')  # restore cursor
+        write_parts((b'\0338',))  # restore cursor
     if not errors:
         return
     for err in errors:
@@ -0,0 +1,95 @@
+/*
+ * speedup.c
+ * Copyright (C) 2018 Kovid Goyal <kovid at kovidgoyal.net>
+ *
+ * Distributed under terms of the GPL3 license.
+ */
+
+#include "data-types.h"
+
+// Every chunk of CHUNK_SZ source bytes becomes exactly 4096 bytes of base64
+#define CHUNK_SZ 3072u
+
+static const char b64_table[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+static inline size_t
+b64_encode(const uint8_t *src, size_t src_sz, char *dest) {
+    char *p = dest;
+    size_t i = 0;
+    for (; i + 2 < src_sz; i += 3) {
+        const uint32_t v = (src[i] << 16) | (src[i+1] << 8) | src[i+2];
+        *(p++) = b64_table[(v >> 18) & 0x3f];
+        *(p++) = b64_table[(v >> 12) & 0x3f];
+        *(p++) = b64_table[(v >> 6) & 0x3f];
+        *(p++) = b64_table[v & 0x3f];
+    }
+    if (i < src_sz) {
+        uint32_t v = src[i] << 16;
+        if (i + 1 < src_sz) v |= src[i+1] << 8;
+        *(p++) = b64_table[(v >> 18) & 0x3f];
+        *(p++) = b64_table[(v >> 12) & 0x3f];
+        *(p++) = i + 1 < src_sz ? b64_table[(v >> 6) & 0x3f] : '=';
+        *(p++) = '=';
+    }
+    return p - dest;
+}
+
+static PyObject*
+serialize_chunks(PyObject *self UNUSED, PyObject *args) {
+    const char *header; Py_ssize_t header_sz;
+    Py_buffer data;
+    int more;
+    if (!PyArg_ParseTuple(args, "y#y*p", &header, &header_sz, &data, &more)) return NULL;
+    const uint8_t *src = data.buf;
+    const size_t sz = data.len;
+    size_t num_chunks, consumed;
+    if (more) {
+        // The last chunk is held back so that it can be sent with m=0 once
+        // it is known that no more data follows
+        num_chunks = sz > CHUNK_SZ ? (sz - 1) / CHUNK_SZ : 0;
+        consumed = num_chunks * CHUNK_SZ;
+    } else {
+        num_chunks = (sz + CHUNK_SZ - 1) / CHUNK_SZ;
+        consumed = sz;
+    }
+    // \033_G <header,> m=x; <payload> \033\\ per chunk
+    size_t out_sz = num_chunks * (3 + 4 + 2) + 4 * ((consumed + 2) / 3);
+    if (num_chunks && header_sz) out_sz += header_sz + 1;
+    PyObject *ans = PyBytes_FromStringAndSize(NULL, out_sz);
+    if (ans == NULL) { PyBuffer_Release(&data); return NULL; }
+    char *p = PyBytes_AS_STRING(ans);
+    for (size_t i = 0, pos = 0; i < num_chunks; i++, pos += CHUNK_SZ) {
+        memcpy(p, "\033_G", 3); p += 3;
+        if (i == 0 && header_sz) {
+            memcpy(p, header, header_sz); p += header_sz;
+            *(p++) = ',';
+        }
+        memcpy(p, pos + CHUNK_SZ < consumed || more ? "m=1;" : "m=0;", 4); p += 4;
+        p += b64_encode(src + pos, MIN(CHUNK_SZ, consumed - pos), p);
+        memcpy(p, "\033\\", 2); p += 2;
+    }
+    PyBuffer_Release(&data);
+    return Py_BuildValue("Nn", ans, (Py_ssize_t)consumed);
+}
+
+static PyMethodDef module_methods[] = {
+    {"serialize_chunks", (PyCFunction)serialize_chunks, METH_VARARGS, ""},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+static struct PyModuleDef module = {
+   .m_base = PyModuleDef_HEAD_INIT,
+   .m_name = "icat_speedup",   /* name of module */
+   .m_doc = NULL,
+   .m_size = -1,
+   .m_methods = module_methods
+};
+
+EXPORTED PyMODINIT_FUNC
+PyInit_icat_speedup(void) {
+    PyObject *m;
+
+    m = PyModule_Create(&module);
+    if (m == NULL) return NULL;
+    return m;
+}
@@ -67,6 +67,43 @@ def identify(path):
     return ImageData(parts[0].lower(), int(parts[1]), int(parts[2]), mode)
 
 
+# Modes that PIL converts to RGB(A) correctly, others, such as 16 bit
+# grayscale, are clipped rather than scaled, so are left to ImageMagick
+pil_modes = frozenset({'1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'CMYK'})
+
+
+def pil_image_module():
+    # Imported lazily, as most uses of this module never convert images
+    if not hasattr(pil_image_module, 'ans'):
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+        pil_image_module.ans = Image
+    return pil_image_module.ans
+
+
+def convert_with_pil(path, m, width, height, outfile):
+    # Returns False if the image must be converted with ImageMagick instead
+    Image = pil_image_module()
+    if Image is None:
+        return False
+    try:
+        with Image.open(path) as img:
+            if img.mode not in pil_modes:
+                return False
+            img = img.convert('RGB' if m.mode == 'rgb' else 'RGBA')
+        if (width, height) != img.size:
+            img = img.resize((width, height), Image.BILINEAR)
+        data = img.tobytes()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # ImageMagick can handle some images PIL rejects, such as truncated
+        # files or images larger than the PIL decompression bomb limit
+        return False
+    outfile.write(data)
+    return True
+
+
 def convert(path, m, available_width, available_height, scale_up, tdir=None):
     from tempfile import NamedTemporaryFile
     width, height = m.width, m.height
@@ -81,7 +118,13 @@ def convert(path, m, available_width, available_height, scale_up, tdir=None):
         width, height = fit_image(width, height, available_width, available_height)
         cmd += ['-resize', '{}x{}!'.format(width, height)]
     with NamedTemporaryFile(prefix='icat-', suffix='.' + m.mode, delete=False, dir=tdir) as outfile:
-        run_imagemagick(path, cmd + [outfile.name])
+        converted = False
+        if m.fmt in ('png', 'jpeg'):
+            # Decode and resize in process, avoiding the cost of running
+            # ImageMagick for the most common formats
+            converted = convert_with_pil(path, m, width, height, outfile)
+        if not converted:
+            run_imagemagick(path, cmd + [outfile.name])
     # ImageMagick sometimes generated rgba images smaller than the specified
     # size. See https://github.com/kovidgoyal/kitty/issues/276 for examples
     sz = os.path.getsize(outfile.name)
@@ -254,7 +297,8 @@ class ImageManager:
             cmd['S'] = len(data)
             data = zlib.compress(data)
             cmd['o'] = 'z'
-            data = standard_b64encode(data)
+            # memoryview slicing avoids copying the remaining data for every chunk
+            data = memoryview(standard_b64encode(data))
             while data:
                 chunk, data = data[:4096], data[4096:]
                 m = 1 if data else 0
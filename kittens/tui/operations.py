@@ -163,16 +163,18 @@ def styled(text, fg=None, bg=None, fg_intense=False, bg_intense=False, italic=No
     return '\033[{}m{}\033[{}m'.format(';'.join(start), text, ';'.join(end))
 
 
-def serialize_gr_command(cmd, payload=None):
+def gr_command_parts(cmd, payload=None):
     cmd = ','.join('{}={}'.format(k, v) for k, v in cmd.items())
-    ans = []
-    w = ans.append
-    w(b'\033_G'), w(cmd.encode('ascii'))
+    header = b'\033_G' + cmd.encode('ascii')
     if payload:
-        w(b';')
-        w(payload)
-    w(b'\033\\')
-    return b''.join(ans)
+        header += b';'
+    else:
+        payload = b''
+    return header, payload, b'\033\\'
+
+
+def serialize_gr_command(cmd, payload=None):
+    return b''.join(gr_command_parts(cmd, payload))
 
 
 def gr_command(cmd, payload=None) -> str:
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import re
+import sys
+import tempfile
+import threading
+import zlib
+from base64 import standard_b64decode, standard_b64encode
+
+from . import BaseTest
+
+
+class TestICat(BaseTest):
+
+    def test_serialize_chunks(self):
+        from kittens.icat.icat_speedup import serialize_chunks
+        from kittens.tui.operations import serialize_gr_command
+
+        def expected(header, data, more):
+            ans = []
+            cmd = dict(x.split('=') for x in header.decode('ascii').split(',')) if header else {}
+            limit = len(data) if not more else max(0, (len(data) - 1) // 3072 * 3072)
+            for i in range(0, limit, 3072):
+                cmd['m'] = 1 if more or i + 3072 < limit else 0
+                ans.append(serialize_gr_command(cmd, standard_b64encode(data[i:i + 3072])))
+                cmd.clear()
+            return b''.join(ans), limit
+
+        for sz in (0, 1, 2, 3, 3071, 3072, 3073, 6144, 10000):
+            data = bytes(range(256)) * (sz // 256) + bytes(range(sz % 256))
+            for header in (b'', b'a=T,f=32'):
+                for more in (True, False):
+                    self.ae(serialize_chunks(header, data, more), expected(header, data, more))
+
+    def test_scan(self):
+        from kittens.icat.main import scan
+        with tempfile.TemporaryDirectory() as tdir:
+            def a(*parts):
+                path = os.path.join(tdir, *parts)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'wb').close()
+
+            a('a.PNG'), a('b.jpeg'), a('notes.txt'), a('noext')
+            a('sub', 'c.Gif'), a('sub', 'deep', 'd.svg'), a('sub', 'deep', 'e.TIF')
+            os.symlink(os.path.join(tdir, 'sub'), os.path.join(tdir, 'link.png'))
+            os.symlink(os.path.join(tdir, 'sub'), os.path.join(tdir, 'linkdir'))
+            os.symlink(os.path.join(tdir, 'a.PNG'), os.path.join(tdir, 'f.png'))
+            found = {os.path.relpath(path, tdir): mt for path, mt in scan(tdir)}
+            self.ae(found, {
+                'a.PNG': 'image/png', 'b.jpeg': 'image/jpeg', 'f.png': 'image/png',
+                os.path.join('sub', 'c.Gif'): 'image/gif',
+                os.path.join('sub', 'deep', 'd.svg'): 'image/svg+xml',
+                os.path.join('sub', 'deep', 'e.TIF'): 'image/tiff',
+            })
+
+    def test_parse_gr_responses(self):
+        from kittens.icat.main import parse_gr_responses
+        reads = [b'noise\033_Gi=1;O', b'K\033', b'\\\033_Gi=2', b';OK\033\\trailing']
+        received, scan_from, responses = bytearray(), 0, [None, None]
+        states = []
+        for data in reads:
+            received += data
+            scan_from = parse_gr_responses(received, scan_from, responses)
+            states.append((scan_from, list(responses)))
+        first_end = len(b'noise\033_Gi=1;OK\033\\')
+        self.ae(states, [
+            (0, [None, None]), (0, [None, None]), (first_end, [True, None]),
+            (len(received) - len(b'trailing'), [True, True])])
+        # Already scanned replies are not scanned again
+        responses = [None, None]
+        self.ae(parse_gr_responses(received, scan_from, responses), scan_from)
+        self.ae(responses, [None, None])
+        # An error reply is a reply, so it ends the wait
+        responses = [None, None]
+        parse_gr_responses(b'\033_Gi=2;ENOENT:no such file\033\\\033_Gi=1;OK\033\\', 0, responses)
+        self.ae(responses, [True, False])
+        # Only the first reply for each id counts
+        responses = [None, None]
+        received = b'\033_Gi=1;EINVAL:bad\033\\\033_Gi=1;OK\033\\\033_Gi=2;OK\033\\\033_Gi=2;EBADF:x\033\\'
+        self.ae(parse_gr_responses(received, 0, responses), len(received))
+        self.ae(responses, [False, True])
+
+    def test_write_to_terminal(self):
+        from kittens.icat.main import iov_max, write_to_terminal
+        parts = [b'' if i % 7 == 0 else bytes([i % 256]) * (i % 300) for i in range(3 * iov_max + 5)]
+        r, w = os.pipe()
+        received = []
+
+        def reader():
+            # read in small amounts so that the pipe fills up
+            while True:
+                data = os.read(r, 97)
+                if not data:
+                    break
+                received.append(data)
+
+        t = threading.Thread(target=reader)
+        t.start()
+        orig_stdout = sys.stdout
+        try:
+            sys.stdout = open(w, 'w')
+            write_to_terminal(parts)
+        finally:
+            sys.stdout.close()
+            sys.stdout = orig_stdout
+            t.join()
+            os.close(r)
+        self.ae(b''.join(received), b''.join(parts))
+
+    def test_write_chunked(self):
+        import kittens.icat.main as icat
+        orig_write_parts, orig_serialize_chunks = icat.write_parts, icat.serialize_chunks
+        output = []
+        icat.write_parts = output.extend
+        pat = re.compile(rb'\033_G([^;\033]+);([^\033]+)\033\\')
+        try:
+            # Test both the C and the pure python implementations
+            for serialize_chunks in {None, orig_serialize_chunks}:
+                icat.serialize_chunks = serialize_chunks
+                for sz in (1, 3071, 3072, 3073, 49151, 49152, 49153, 100000):
+                    data = os.urandom(sz)
+                    for fmt in (32, 100):
+                        del output[:]
+                        icat.write_chunked({'a': 'T', 'f': fmt}, data)
+                        raw = b''.join(map(bytes, output))
+                        chunks = pat.findall(raw)
+                        self.ae(sum(len(h) + len(p) + 6 for h, p in chunks), len(raw))
+                        cmds = [dict(x.split('=') for x in h.decode('ascii').split(',')) for h, p in chunks]
+                        self.ae(cmds[0]['a'], 'T')
+                        self.ae(cmds[0]['f'], str(fmt))
+                        self.ae(cmds[0].get('o'), None if fmt == 100 else 'z')
+                        self.ae([c['m'] for c in cmds], ['1'] * (len(cmds) - 1) + ['0'])
+                        self.assertTrue(all(len(c) == 1 for c in cmds[1:]))
+                        self.assertTrue(all(len(p) == 4096 for h, p in chunks[:-1]))
+                        self.assertLessEqual(len(chunks[-1][1]), 4096)
+                        payload = b''.join(standard_b64decode(p) for h, p in chunks)
+                        if fmt != 100:
+                            payload = zlib.decompress(payload)
+                        self.ae(payload, data)
+        finally:
+            icat.write_parts, icat.serialize_chunks = orig_write_parts, orig_serialize_chunks
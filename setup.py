@@ -458,6 +458,7 @@ def compile_kittens(incremental, compilation_database, all_keys):
     for sources, all_headers, dest in [
         (['kittens/unicode_input/unicode_names.c'], ['kittens/unicode_input/names.h', 'kitty/data-types.h'],  'kittens/unicode_input/unicode_names'),
         (['kittens/diff/speedup.c'], ['kitty/data-types.h'], 'kittens/diff/diff_speedup'),
+        (['kittens/icat/speedup.c'], ['kitty/data-types.h'], 'kittens/icat/icat_speedup'),
     ]:
         compile_c_extension(kenv, dest, incremental, compilation_database, all_keys, sources, all_headers)
 